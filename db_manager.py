@@ -1,8 +1,10 @@
 import sqlite3
 import os
-import json
+import orjson
+import threading
+from operator import itemgetter
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Optional, Tuple, Set
 import logging
 
 logging.basicConfig(
@@ -11,11 +13,89 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Incrementar al cambiar tablas, índices o migraciones para que _init_database vuelva a ejecutarse
+SCHEMA_VERSION = 2
+
+SQL_MAX_PARAMS = 900
+
+_INCIDENT_COLUMNS = (
+    'incident_id', 'file_name', 'file_path', 'file_type',
+    'file_size', 'user_email', 'cyberhaven_data', 'status',
+    'severity', 'policy_severity', 'incident_date'
+)
+_INCIDENT_DEFAULTS = dict.fromkeys(_INCIDENT_COLUMNS)
+_INCIDENT_DEFAULTS['status'] = 'downloaded'
+_incident_values = itemgetter(*_INCIDENT_COLUMNS)
+
+_SQL_INSERT_INCIDENT = '''
+    INSERT INTO incidents (
+        incident_id, file_name, file_path, file_type, 
+        file_size, user_email, cyberhaven_data, status,
+        severity, policy_severity, incident_date, downloaded_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime'))
+'''
+_SQL_INSERT_INCIDENT_IGNORE = _SQL_INSERT_INCIDENT.replace('INSERT INTO', 'INSERT OR IGNORE INTO', 1)
+
+_SQL_UPDATE_STATUS = '''
+    UPDATE incidents
+    SET status = ?,
+        analyzed_at = CASE WHEN ? = 'analyzed'
+            THEN strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime')
+            ELSE analyzed_at END
+    WHERE incident_id = ?
+'''
+
+_ANALYSIS_DEFAULTS = dict.fromkeys((
+    'incident_id', 'gemini_verdict', 'gemini_confidence',
+    'gemini_reasoning', 'gemini_raw_response', 'executive_summary',
+    'risk_level', 'processing_time'
+))
+_ANALYSIS_DEFAULTS['tokens_used'] = 0
+_analysis_values = itemgetter(*_ANALYSIS_DEFAULTS)
+
+_SQL_INSERT_ANALYSIS = '''
+    INSERT OR REPLACE INTO analysis (
+        incident_id, gemini_verdict, gemini_confidence, 
+        gemini_reasoning, gemini_raw_response, executive_summary,
+        risk_level, processing_time, tokens_used
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+_FEEDBACK_DEFAULTS = dict.fromkeys((
+    'incident_id', 'analysis_id', 'original_verdict',
+    'corrected_verdict', 'analyst_comment', 'relevance_score'
+))
+_feedback_values = itemgetter(*_FEEDBACK_DEFAULTS)
+
+_SQL_INSERT_FEEDBACK = '''
+    INSERT INTO feedback (
+        incident_id, analysis_id, original_verdict, 
+        corrected_verdict, analyst_comment, relevance_score
+    ) VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+
+def _fetch_dicts(cursor) -> List[Dict]:
+    # dict(zip(...)) con las columnas resueltas una vez es más rápido que dict(sqlite3.Row) por fila
+    columns = [col[0] for col in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def _incident_params(incident_data: Dict) -> Tuple:
+    values = _incident_values({**_INCIDENT_DEFAULTS, **incident_data})
+    if isinstance(values[6], dict):
+        values = list(values)
+        values[6] = orjson.dumps(values[6], option=orjson.OPT_NON_STR_KEYS)
+    return tuple(values)
+
 
 class DatabaseManager:
     
     def __init__(self, db_path: str = "./data/incidents.db"):
         self.db_path = db_path
+        self._conn = None
+        self._lock = threading.RLock()
+        self._feedback_version = 0
         self._ensure_db_directory()
         self._init_database()
         logger.info(f"DatabaseManager inicializado con DB: {db_path}")
@@ -27,14 +107,34 @@ class DatabaseManager:
             logger.info(f"Directorio creado: {db_dir}")
     
     def _get_connection(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
+        # Conexión única reutilizada por todos los métodos; self._lock serializa su uso entre hilos
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256)
+            self._conn.row_factory = sqlite3.Row
+            # WAL persiste en el archivo; el resto de PRAGMAs aplican por conexión
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA temp_store=MEMORY")
+            self._conn.execute("PRAGMA cache_size=-64000")
+            self._conn.execute("PRAGMA mmap_size=268435456")
+            self._conn.execute("PRAGMA busy_timeout=5000")
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
     
     def _init_database(self):
         conn = self._get_connection()
         cursor = conn.cursor()
         
+        cursor.execute("PRAGMA user_version")
+        if cursor.fetchone()[0] == SCHEMA_VERSION:
+            logger.debug("Esquema de base de datos al día")
+            return
+        
         try:
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS incidents (
@@ -44,7 +144,7 @@ class DatabaseManager:
                     file_type TEXT,
                     file_size INTEGER,
                     user_email TEXT,
-                    cyberhaven_data TEXT,
+                    cyberhaven_data BLOB,
                     status TEXT DEFAULT 'downloaded',
                     severity TEXT,
                     policy_severity TEXT,
@@ -105,12 +205,32 @@ class DatabaseManager:
                     incidents_analyzed INTEGER DEFAULT 0,
                     total_tokens INTEGER DEFAULT 0,
                     errors INTEGER DEFAULT 0,
+                    cache_hits INTEGER DEFAULT 0,
+                    download_seconds REAL,
+                    analysis_seconds REAL,
                     started_at TIMESTAMP,
                     completed_at TIMESTAMP
                 )
             ''')
 
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    model_name TEXT,
+                    raw_response TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
             self._migrate_existing_data(cursor)
+
+            # Índice parcial para get_pending_incidents (filtro + orden); requiere downloaded_at migrado
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_incidents_pending ON incidents(status, downloaded_at)
+                WHERE status = 'downloaded'
+            ''')
+
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
             
             conn.commit()
             logger.info("Base de datos inicializada correctamente")
@@ -119,8 +239,6 @@ class DatabaseManager:
             logger.error(f"Error inicializando base de datos: {e}")
             conn.rollback()
             raise
-        finally:
-            conn.close()
 
     def _migrate_existing_data(self, cursor):
         cursor.execute("PRAGMA table_info(incidents)")
@@ -138,158 +256,194 @@ class DatabaseManager:
             if col not in columns:
                 logger.info(f"Migrando DB: Agregando columna '{col}'")
                 cursor.execute(sql)
+        
+        cursor.execute("PRAGMA table_info(processing_log)")
+        log_columns = [info[1] for info in cursor.fetchall()]
+        
+        log_migrations = {
+            'cache_hits': "ALTER TABLE processing_log ADD COLUMN cache_hits INTEGER DEFAULT 0",
+            'download_seconds': "ALTER TABLE processing_log ADD COLUMN download_seconds REAL",
+            'analysis_seconds': "ALTER TABLE processing_log ADD COLUMN analysis_seconds REAL"
+        }
+        
+        for col, sql in log_migrations.items():
+            if col not in log_columns:
+                logger.info(f"Migrando DB: Agregando columna '{col}' a processing_log")
+                cursor.execute(sql)
     
     def insert_incident(self, incident_data: Dict) -> bool:
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                INSERT INTO incidents (
-                    incident_id, file_name, file_path, file_type, 
-                    file_size, user_email, cyberhaven_data, status,
-                    severity, policy_severity, incident_date, downloaded_at
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                incident_data.get('incident_id'),
-                incident_data.get('file_name'),
-                incident_data.get('file_path'),
-                incident_data.get('file_type'),
-                incident_data.get('file_size'),
-                incident_data.get('user_email'),
-                json.dumps(incident_data.get('cyberhaven_data', {})) if isinstance(incident_data.get('cyberhaven_data'), dict) else incident_data.get('cyberhaven_data'),
-                incident_data.get('status', 'downloaded'),
-                incident_data.get('severity'),
-                incident_data.get('policy_severity'),
-                incident_data.get('incident_date'),
-                datetime.now().isoformat()
-            ))
-            conn.commit()
-            logger.info(f"Incidente insertado: {incident_data.get('incident_id')}")
-            return True
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            try:
+                cursor.execute(_SQL_INSERT_INCIDENT, _incident_params(incident_data))
+                conn.commit()
+                logger.info(f"Incidente insertado: {incident_data.get('incident_id')}")
+                return True
             
-        except sqlite3.IntegrityError:
-            logger.debug(f"Incidente ya existe: {incident_data.get('incident_id')}")
-            return False
-        except sqlite3.Error as e:
-            logger.error(f"Error insertando incidente: {e}")
-            conn.rollback()
-            return False
-        finally:
-            conn.close()
+            except sqlite3.IntegrityError:
+                logger.debug(f"Incidente ya existe: {incident_data.get('incident_id')}")
+                return False
+            except sqlite3.Error as e:
+                logger.error(f"Error insertando incidente: {e}")
+                conn.rollback()
+                return False
     
+    def insert_incidents_bulk(self, incidents: List[Dict]) -> int:
+        if not incidents:
+            return 0
+        rows = [_incident_params(inc) for inc in incidents]
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            try:
+                before = conn.total_changes
+                cursor.executemany(_SQL_INSERT_INCIDENT_IGNORE, rows)
+                conn.commit()
+                inserted = conn.total_changes - before
+                logger.info(f"Incidentes insertados en lote: {inserted}/{len(rows)}")
+                return inserted
+            except sqlite3.Error as e:
+                logger.error(f"Error insertando incidentes en lote: {e}")
+                conn.rollback()
+                return 0
+
     def incident_exists(self, incident_id: str) -> bool:
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        try:
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
             cursor.execute('SELECT 1 FROM incidents WHERE incident_id = ? LIMIT 1', (incident_id,))
             return cursor.fetchone() is not None
-        finally:
-            conn.close()
+
+    def get_existing_incident_ids(self, incident_ids: List[str]) -> Set[str]:
+        existing = set()
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            # Troceamos por debajo del límite de parámetros de SQLite (999 en versiones antiguas)
+            for start in range(0, len(incident_ids), SQL_MAX_PARAMS):
+                chunk = incident_ids[start:start + SQL_MAX_PARAMS]
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f'SELECT incident_id FROM incidents WHERE incident_id IN ({placeholders})', chunk)
+                existing.update(row[0] for row in cursor.fetchall())
+        return existing
 
     def is_incident_analyzed(self, incident_id: str) -> bool:
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        try:
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
             cursor.execute('SELECT 1 FROM analysis WHERE incident_id = ? LIMIT 1', (incident_id,))
             return cursor.fetchone() is not None
-        finally:
-            conn.close()
 
-    def get_pending_incidents(self, limit: int = 10) -> List[Dict]:
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                SELECT i.* FROM incidents i
-                LEFT JOIN analysis a ON i.incident_id = a.incident_id
-                WHERE a.id IS NULL AND i.status = 'downloaded'
-                ORDER BY i.downloaded_at ASC
-                LIMIT ?
-            ''', (limit,))
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
-        finally:
-            conn.close()
+    def get_pending_incidents(self, limit: int = 10, incident_ids: Optional[List[str]] = None) -> List[Dict]:
+        if incident_ids is not None and not incident_ids:
+            return []
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            if incident_ids is None:
+                cursor.execute('''
+                    SELECT i.* FROM incidents i
+                    LEFT JOIN analysis a ON i.incident_id = a.incident_id
+                    WHERE a.id IS NULL AND i.status = 'downloaded'
+                    ORDER BY i.downloaded_at ASC
+                    LIMIT ?
+                ''', (limit,))
+                return _fetch_dicts(cursor)
+            
+            # Restringido a unos ids concretos (p. ej. los recién descargados)
+            pending = []
+            for start in range(0, len(incident_ids), SQL_MAX_PARAMS):
+                if len(pending) >= limit:
+                    break
+                chunk = incident_ids[start:start + SQL_MAX_PARAMS]
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f'''
+                    SELECT i.* FROM incidents i
+                    LEFT JOIN analysis a ON i.incident_id = a.incident_id
+                    WHERE a.id IS NULL AND i.status = 'downloaded'
+                      AND i.incident_id IN ({placeholders})
+                    ORDER BY i.downloaded_at ASC
+                    LIMIT ?
+                ''', (*chunk, limit - len(pending)))
+                pending.extend(_fetch_dicts(cursor))
+            return pending
 
     def get_incident(self, incident_id: str) -> Optional[Dict]:
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        try:
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
             cursor.execute('SELECT * FROM incidents WHERE incident_id = ?', (incident_id,))
             row = cursor.fetchone()
             return dict(row) if row else None
-        finally:
-            conn.close()
     
     def get_incidents_by_date(self, date: str) -> List[Dict]:
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        try:
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
             cursor.execute('''
                 SELECT * FROM incidents 
                 WHERE incident_date = ?
                 ORDER BY downloaded_at DESC
             ''', (date,))
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
-        finally:
-            conn.close()
+            return _fetch_dicts(cursor)
 
     def update_incident_status(self, incident_id: str, status: str) -> bool:
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("UPDATE incidents SET status = ? WHERE incident_id = ?", (status, incident_id))
-            if status == 'analyzed':
-                cursor.execute("UPDATE incidents SET analyzed_at = ? WHERE incident_id = ?", 
-                             (datetime.now().isoformat(), incident_id))
-            conn.commit()
-            return True
-        except sqlite3.Error as e:
-            logger.error(f"Error updating status: {e}")
-            return False
-        finally:
-            conn.close()
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            try:
+                cursor.execute(_SQL_UPDATE_STATUS, (status, status, incident_id))
+                conn.commit()
+                return True
+            except sqlite3.Error as e:
+                logger.error(f"Error updating status: {e}")
+                return False
 
     def insert_analysis(self, analysis_data: Dict) -> int:
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                INSERT OR REPLACE INTO analysis (
-                    incident_id, gemini_verdict, gemini_confidence, 
-                    gemini_reasoning, gemini_raw_response, executive_summary,
-                    risk_level, processing_time, tokens_used
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                analysis_data.get('incident_id'),
-                analysis_data.get('gemini_verdict'),
-                analysis_data.get('gemini_confidence'),
-                analysis_data.get('gemini_reasoning'),
-                analysis_data.get('gemini_raw_response'),
-                analysis_data.get('executive_summary'),
-                analysis_data.get('risk_level'),
-                analysis_data.get('processing_time'),
-                analysis_data.get('tokens_used', 0)
-            ))
-            conn.commit()
-            analysis_id = cursor.lastrowid
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            try:
+                # INSERT y cambio de estado en una única transacción
+                cursor.execute(_SQL_INSERT_ANALYSIS, _analysis_values({**_ANALYSIS_DEFAULTS, **analysis_data}))
+                analysis_id = cursor.lastrowid
+                cursor.execute(_SQL_UPDATE_STATUS, ('analyzed', 'analyzed', analysis_data.get('incident_id')))
+                conn.commit()
             
-            self.update_incident_status(analysis_data.get('incident_id'), 'analyzed')
-            
-            logger.info(f"Análisis insertado ID: {analysis_id}")
-            return analysis_id
-        except sqlite3.Error as e:
-            logger.error(f"Error insertando análisis: {e}")
-            conn.rollback()
-            return -1
-        finally:
-            conn.close()
+                logger.info(f"Análisis insertado ID: {analysis_id}")
+                return analysis_id
+            except sqlite3.Error as e:
+                logger.error(f"Error insertando análisis: {e}")
+                conn.rollback()
+                return -1
+
+    def insert_analyses_bulk(self, analyses: List[Dict]) -> int:
+        if not analyses:
+            return 0
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            try:
+                # Todos los análisis del lote y sus cambios de estado en una única transacción
+                cursor.executemany(_SQL_INSERT_ANALYSIS, [
+                    _analysis_values({**_ANALYSIS_DEFAULTS, **data}) for data in analyses
+                ])
+                cursor.executemany(_SQL_UPDATE_STATUS, [
+                    ('analyzed', 'analyzed', data.get('incident_id')) for data in analyses
+                ])
+                conn.commit()
+                logger.info(f"Análisis insertados en lote: {len(analyses)}")
+                return len(analyses)
+            except sqlite3.Error as e:
+                logger.error(f"Error insertando análisis en lote: {e}")
+                conn.rollback()
+                return 0
 
     def get_latest_analysis(self, incident_id: str) -> Optional[Dict]:
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        try:
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
             cursor.execute('''
                 SELECT * FROM analysis 
                 WHERE incident_id = ? 
@@ -298,39 +452,120 @@ class DatabaseManager:
             ''', (incident_id,))
             row = cursor.fetchone()
             return dict(row) if row else None
-        finally:
-            conn.close()
 
-    def insert_feedback(self, feedback_data: Dict) -> bool:
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        try:
+    def get_incident_with_latest_analysis(self, incident_id: str) -> Optional[Tuple[Dict, Optional[Dict]]]:
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            # Incidente y último análisis en una sola consulta; la columna marcador separa ambas filas
             cursor.execute('''
-                INSERT INTO feedback (
-                    incident_id, analysis_id, original_verdict, 
-                    corrected_verdict, analyst_comment, relevance_score
-                ) VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                feedback_data.get('incident_id'),
-                feedback_data.get('analysis_id'),
-                feedback_data.get('original_verdict'),
-                feedback_data.get('corrected_verdict'),
-                feedback_data.get('analyst_comment'),
-                feedback_data.get('relevance_score')
-            ))
-            conn.commit()
-            return True
-        except sqlite3.Error as e:
-            logger.error(f"Error insertando feedback: {e}")
-            conn.rollback()
-            return False
-        finally:
-            conn.close()
+                SELECT i.*, NULL AS _analysis_start, a.*
+                FROM incidents i
+                LEFT JOIN analysis a ON a.id = (
+                    SELECT id FROM analysis
+                    WHERE incident_id = i.incident_id
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT 1
+                )
+                WHERE i.incident_id = ?
+            ''', (incident_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            
+            columns = [col[0] for col in cursor.description]
+            split = columns.index('_analysis_start')
+            incident = dict(zip(columns[:split], row[:split]))
+            analysis = None
+            if row[split + 1] is not None:
+                analysis = dict(zip(columns[split + 1:], row[split + 1:]))
+            return incident, analysis
+
+    def get_latest_analyses_for(self, incident_ids: List[str]) -> Dict[str, Dict]:
+        latest = {}
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            for start in range(0, len(incident_ids), SQL_MAX_PARAMS):
+                chunk = incident_ids[start:start + SQL_MAX_PARAMS]
+                placeholders = ','.join('?' * len(chunk))
+                # Último análisis por incidente en una sola consulta, en lugar de una por incidente
+                cursor.execute(f'''
+                    SELECT * FROM (
+                        SELECT *, ROW_NUMBER() OVER (
+                            PARTITION BY incident_id ORDER BY created_at DESC, id DESC
+                        ) AS rn
+                        FROM analysis
+                        WHERE incident_id IN ({placeholders})
+                    ) WHERE rn = 1
+                ''', chunk)
+                for row in _fetch_dicts(cursor):
+                    del row['rn']
+                    latest[row['incident_id']] = row
+        return latest
+
+    def insert_feedback(self, feedback_data: Dict) -> bool:
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            try:
+                cursor.execute(_SQL_INSERT_FEEDBACK, _feedback_values({**_FEEDBACK_DEFAULTS, **feedback_data}))
+                conn.commit()
+                self._feedback_version += 1
+                return True
+            except sqlite3.Error as e:
+                logger.error(f"Error insertando feedback: {e}")
+                conn.rollback()
+                return False
+
+    def has_feedback(self, incident_id: str) -> bool:
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM feedback WHERE incident_id = ? LIMIT 1', (incident_id,))
+            return cursor.fetchone() is not None
+
+    def get_incident_ids_with_feedback(self, incident_ids: List[str]) -> Set[str]:
+        reviewed = set()
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            for start in range(0, len(incident_ids), SQL_MAX_PARAMS):
+                chunk = incident_ids[start:start + SQL_MAX_PARAMS]
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f'SELECT DISTINCT incident_id FROM feedback WHERE incident_id IN ({placeholders})', chunk)
+                reviewed.update(row[0] for row in cursor.fetchall())
+        return reviewed
+
+    def get_analyzed_incidents(self, date: Optional[str] = None, limit: int = 20) -> List[Dict]:
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            if date:
+                cursor.execute('''
+                    SELECT i.*, a.gemini_verdict, a.gemini_confidence, a.executive_summary, 
+                           a.risk_level, a.id as analysis_id
+                    FROM incidents i
+                    JOIN analysis a ON i.incident_id = a.incident_id
+                    WHERE i.incident_date = ?
+                    ORDER BY a.created_at DESC
+                    LIMIT ?
+                ''', (date, limit))
+            else:
+                cursor.execute('''
+                    SELECT i.*, a.gemini_verdict, a.gemini_confidence, a.executive_summary,
+                           a.risk_level, a.id as analysis_id
+                    FROM incidents i
+                    JOIN analysis a ON i.incident_id = a.incident_id
+                    ORDER BY a.created_at DESC
+                    LIMIT ?
+                ''', (limit,))
+            return _fetch_dicts(cursor)
 
     def get_feedback_for_rag(self, limit: int = 5) -> List[Dict]:
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        try:
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
             cursor.execute('''
                 SELECT f.*, i.file_name, i.file_type, a.gemini_reasoning as original_reasoning
                 FROM feedback f
@@ -340,97 +575,129 @@ class DatabaseManager:
                 ORDER BY f.relevance_score DESC, f.created_at DESC
                 LIMIT ?
             ''', (limit,))
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
-        finally:
-            conn.close()
+            return _fetch_dicts(cursor)
+
+    def feedback_version(self) -> Tuple[int, int]:
+        # Cambia cuando hay feedback nuevo: escrituras propias (contador) o de otro proceso (data_version)
+        with self._lock:
+            cursor = self._get_connection().cursor()
+            cursor.execute("PRAGMA data_version")
+            return cursor.fetchone()[0], self._feedback_version
+
+    def get_cached_response(self, cache_key: str, max_age_days: int = 7) -> Optional[str]:
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT raw_response FROM response_cache
+                WHERE cache_key = ? AND created_at >= datetime('now', ?)
+            ''', (cache_key, f'-{max_age_days} days'))
+            row = cursor.fetchone()
+            return row['raw_response'] if row else None
+
+    def store_cached_response(self, cache_key: str, model_name: str, raw_response: str) -> bool:
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            try:
+                cursor.execute('''
+                    INSERT OR REPLACE INTO response_cache (cache_key, model_name, raw_response)
+                    VALUES (?, ?, ?)
+                ''', (cache_key, model_name, raw_response))
+                conn.commit()
+                return True
+            except sqlite3.Error as e:
+                logger.error(f"Error guardando respuesta en caché: {e}")
+                conn.rollback()
+                return False
 
     def log_processing_run(self, run_data: Dict) -> int:
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        try:
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO processing_log (
                     run_date, incidents_downloaded, incidents_analyzed,
-                    total_tokens, errors, started_at, completed_at
-                ) VALUES (?, ?, ?, ?, ?, ?, ?)
+                    total_tokens, errors, cache_hits, download_seconds,
+                    analysis_seconds, started_at, completed_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
                 run_data.get('run_date'),
                 run_data.get('incidents_downloaded', 0),
                 run_data.get('incidents_analyzed', 0),
                 run_data.get('total_tokens', 0),
                 run_data.get('errors', 0),
+                run_data.get('cache_hits', 0),
+                run_data.get('download_seconds'),
+                run_data.get('analysis_seconds'),
                 run_data.get('started_at'),
                 run_data.get('completed_at')
             ))
             conn.commit()
             return cursor.lastrowid
-        finally:
-            conn.close()
 
     def get_database_stats(self) -> Dict:
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        stats = {}
-        try:
-            cursor.execute("SELECT status, COUNT(*) as count FROM incidents GROUP BY status")
-            stats['incidents_by_status'] = {row['status']: row['count'] for row in cursor.fetchall()}
-            
-            cursor.execute("SELECT COUNT(*) as count FROM analysis")
-            stats['total_analyses'] = cursor.fetchone()['count']
-            
-            cursor.execute("SELECT COUNT(*) as count FROM feedback")
-            stats['total_feedback'] = cursor.fetchone()['count']
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            stats = {}
+            try:
+                cursor.execute("SELECT status, COUNT(*) as count FROM incidents GROUP BY status")
+                stats['incidents_by_status'] = {row['status']: row['count'] for row in cursor.fetchall()}
             
-            cursor.execute("SELECT SUM(tokens_used) as total FROM analysis")
-            result = cursor.fetchone()['total']
-            stats['total_tokens_used'] = result if result else 0
+                cursor.execute('''
+                    SELECT
+                        (SELECT COUNT(*) FROM analysis) as total_analyses,
+                        (SELECT COALESCE(SUM(tokens_used), 0) FROM analysis) as total_tokens,
+                        (SELECT COUNT(*) FROM feedback) as total_feedback,
+                        (SELECT COUNT(*) FROM feedback WHERE original_verdict = corrected_verdict) as correct_feedback
+                ''')
+                row = cursor.fetchone()
+                stats['total_analyses'] = row['total_analyses']
+                stats['total_feedback'] = row['total_feedback']
+                stats['total_tokens_used'] = row['total_tokens']
+                total_fb = row['total_feedback']
+                stats['ai_accuracy'] = (row['correct_feedback'] / total_fb) * 100 if total_fb > 0 else 0.0
             
-            cursor.execute("SELECT COUNT(*) as total FROM feedback")
-            total_fb = cursor.fetchone()['total']
-            if total_fb > 0:
-                cursor.execute("SELECT COUNT(*) as correct FROM feedback WHERE original_verdict = corrected_verdict")
-                correct_fb = cursor.fetchone()['correct']
-                stats['ai_accuracy'] = (correct_fb / total_fb) * 100
-            else:
-                stats['ai_accuracy'] = 0.0
-            
-            cursor.execute('''
-                SELECT incident_date, COUNT(*) as count 
-                FROM incidents 
-                WHERE incident_date >= date('now', '-7 days')
-                GROUP BY incident_date
-                ORDER BY incident_date DESC
-            ''')
-            stats['incidents_last_7_days'] = {row['incident_date']: row['count'] for row in cursor.fetchall()}
+                cursor.execute('''
+                    SELECT incident_date, COUNT(*) as count 
+                    FROM incidents 
+                    WHERE incident_date >= date('now', '-7 days')
+                    GROUP BY incident_date
+                    ORDER BY incident_date DESC
+                ''')
+                stats['incidents_last_7_days'] = {row['incident_date']: row['count'] for row in cursor.fetchall()}
             
-            return stats
-        except sqlite3.Error as e:
-            logger.error(f"Error getting stats: {e}")
-            return {}
-        finally:
-            conn.close()
+                return stats
+            except sqlite3.Error as e:
+                logger.error(f"Error getting stats: {e}")
+                return {}
 
     def clear_old_data(self, days: int = 30) -> Tuple[int, int, int]:
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        try:
-            date_limit = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+        with self._lock:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            try:
+                date_limit = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
             
-            cursor.execute("DELETE FROM feedback WHERE incident_id IN (SELECT incident_id FROM incidents WHERE incident_date < ?)", (date_limit,))
-            deleted_feedback = cursor.rowcount
+                # Materializamos los incidentes a borrar una sola vez (temp_store=MEMORY)
+                cursor.execute("DROP TABLE IF EXISTS temp._victims")
+                cursor.execute("CREATE TEMP TABLE _victims AS SELECT incident_id FROM incidents WHERE incident_date < ?", (date_limit,))
             
-            cursor.execute("DELETE FROM analysis WHERE incident_id IN (SELECT incident_id FROM incidents WHERE incident_date < ?)", (date_limit,))
-            deleted_analysis = cursor.rowcount
+                cursor.execute("DELETE FROM feedback WHERE incident_id IN (SELECT incident_id FROM _victims)")
+                deleted_feedback = cursor.rowcount
             
-            cursor.execute("DELETE FROM incidents WHERE incident_date < ?", (date_limit,))
-            deleted_incidents = cursor.rowcount
+                cursor.execute("DELETE FROM analysis WHERE incident_id IN (SELECT incident_id FROM _victims)")
+                deleted_analysis = cursor.rowcount
             
-            conn.commit()
-            return (deleted_incidents, deleted_analysis, deleted_feedback)
-        except sqlite3.Error as e:
-            logger.error(f"Error clearing old data: {e}")
-            conn.rollback()
-            return (0, 0, 0)
-        finally:
-            conn.close()
\ No newline at end of file
+                cursor.execute("DELETE FROM incidents WHERE incident_id IN (SELECT incident_id FROM _victims)")
+                deleted_incidents = cursor.rowcount
+            
+                conn.commit()
+                self._feedback_version += 1
+                cursor.execute("DROP TABLE temp._victims")
+                return (deleted_incidents, deleted_analysis, deleted_feedback)
+            except sqlite3.Error as e:
+                logger.error(f"Error clearing old data: {e}")
+                conn.rollback()
+                return (0, 0, 0)
\ No newline at end of file
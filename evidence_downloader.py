@@ -1,7 +1,14 @@
 import os
-import boto3
+import re
+import sys
+import base64
+import time
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from pathlib import Path
 import logging
@@ -20,24 +27,97 @@ BASE_INCIDENTS_DIR = os.getenv("INCIDENTS_DIR", "./data/incidents")
 
 SEVERITY_FILTER = ["high", "critical"]
 
+_SHA256_HEX = re.compile(r'[0-9a-fA-F]{64}\Z')
+
+# Sufijos de objetos S3 que son metadatos, no la evidencia
+_META_SUFFIXES = ('.html', '.json')
+
 # Tipos de fuentes donde es normal NO encontrar archivo en S3 (Solo metadatos)
 METADATA_ONLY_SOURCES = ['mail', 'cloud', 'saas']
 METADATA_ONLY_ACTIONS = ['email_send', 'cloud_share']
 
+DOWNLOAD_WORKERS = int(os.getenv("S3_CONCURRENCY", "16"))
+
+# Con muchos hilos urllib3 avisa de "Connection pool is full"; es ruido, no un error
+logging.getLogger("urllib3.connectionpool").setLevel(logging.ERROR)
+
+# Descarga multipart concurrente para evidencias grandes (>8 MB), escribiendo a disco en bloques de 1 MB
+S3_TRANSFER_CONCURRENCY = 10
+S3_TRANSFER_SETTINGS = dict(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=S3_TRANSFER_CONCURRENCY,
+    io_chunksize=1024 * 1024,
+    use_threads=True
+)
+
+# boto3 se importa al crear el primer cliente: cargarlo cuesta cientos de ms
+_s3_client = None
+_s3_transfer_config = None
+_s3_client_lock = threading.Lock()
+
+# Access token en memoria hasta su 'exp' (con margen) para no pedirlo en cada ciclo
+TOKEN_REFRESH_MARGIN = 30
+_token_cache: Optional[Tuple[str, float]] = None
+_token_lock = threading.Lock()
+
+# Sesión HTTP compartida: reutiliza la conexión TLS con Cyberhaven entre llamadas
+_http = requests.Session()
+_http.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], allowed_methods=None)
+))
+
+
+def get_s3_client():
+    # Un solo cliente por proceso: crearlo carga el modelo de servicio de botocore
+    global _s3_client, _s3_transfer_config
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                import boto3
+                from boto3.s3.transfer import TransferConfig
+                from botocore.config import Config
+                _s3_transfer_config = TransferConfig(**S3_TRANSFER_SETTINGS)
+                # Cada hilo de descarga puede abrir hasta S3_TRANSFER_CONCURRENCY rangos a la vez
+                _s3_client = boto3.client('s3', config=Config(
+                    max_pool_connections=DOWNLOAD_WORKERS * S3_TRANSFER_CONCURRENCY,
+                    retries={'max_attempts': 3, 'mode': 'adaptive'},
+                    tcp_keepalive=True
+                ))
+    return _s3_client
+
+
+def _token_expiry(token: str) -> float:
+    # Lee el claim 'exp' del JWT sin validar la firma; 0 si no se puede decodificar
+    try:
+        payload = token.split('.')[1]
+        claims = orjson.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims.get('exp', 0))
+    except Exception:
+        return 0.0
+
 
 def get_token() -> Optional[str]:
+    global _token_cache
     if not CYBERHAVEN_TOKEN:
         logger.error("CYBERHAVEN_API_KEY no configurada")
         return None
-    url = f"{CYBERHAVEN_BASE_URL}/v2/auth/token/access"
-    try:
-        # logger.info("Obteniendo access token...")
-        resp = requests.post(url, json={"refresh_token": CYBERHAVEN_TOKEN}, timeout=10)
-        resp.raise_for_status()
-        return resp.json()['access_token']
-    except Exception as e:
-        logger.error(f"Error obteniendo token: {e}")
-        return None
+    with _token_lock:
+        if _token_cache and time.time() < _token_cache[1] - TOKEN_REFRESH_MARGIN:
+            return _token_cache[0]
+        url = f"{CYBERHAVEN_BASE_URL}/v2/auth/token/access"
+        try:
+            # logger.info("Obteniendo access token...")
+            resp = _http.post(url, json={"refresh_token": CYBERHAVEN_TOKEN}, timeout=10)
+            resp.raise_for_status()
+            token = resp.json()['access_token']
+            _token_cache = (token, _token_expiry(token))
+            return token
+        except Exception as e:
+            logger.error(f"Error obteniendo token: {e}")
+            return None
 
 
 def get_date_directory(incident_date: str = None) -> Path:
@@ -48,56 +128,65 @@ def get_date_directory(incident_date: str = None) -> Path:
     return date_dir
 
 
-def download_from_s3(file_hash: str, output_path: str) -> bool:
+def download_from_s3(file_hash: str, output_path: str) -> Optional[int]:
     """
     Busca en S3 usando el hash como prefijo.
     Descarga el primer archivo que NO sea .html ni .json.
+    Devuelve el tamaño descargado en bytes, o None si no hay evidencia.
     """
-    s3 = boto3.client('s3')
+    s3 = get_s3_client()
     try:
         # IMPORTANTE: Usamos Prefix porque S3 añade sufijos al hash
-        response = s3.list_objects_v2(Bucket=BUCKET_NAME, Prefix=file_hash)
+        # El hash es casi único: bastan unas pocas claves (binario + metadatos json/html)
+        response = s3.list_objects_v2(Bucket=BUCKET_NAME, Prefix=file_hash, MaxKeys=10)
         
         if 'Contents' not in response:
-            return False
+            return None
 
         target_key = None
         # Buscamos el archivo binario real (ignorando metadatos json/html)
         for obj in response['Contents']:
             key = obj['Key']
-            if not key.endswith('.html') and not key.endswith('.json'):
+            if not key.endswith(_META_SUFFIXES):
                 target_key = key
+                target_size = obj.get('Size')
                 break
 
         if not target_key:
-            return False
+            return None
+
+        # El listado ya trae el tamaño: evitamos el GET de objetos vacíos
+        if target_size == 0:
+            logger.warning(f"Objeto S3 con 0 bytes: {target_key}")
+            return None
 
-        s3.download_file(BUCKET_NAME, target_key, output_path)
+        s3.download_file(BUCKET_NAME, target_key, output_path, Config=_s3_transfer_config)
         
         # Validación extra: Si bajó 0 bytes, es un archivo vacío/corrupto
-        if os.path.getsize(output_path) == 0:
+        file_size = os.stat(output_path).st_size
+        if file_size == 0:
             logger.warning(f"Archivo descargado tiene 0 bytes: {target_key}")
             try:
                 os.remove(output_path)
             except: pass
-            return False
+            return None
 
-        file_size_mb = os.path.getsize(output_path) / (1024 * 1024)
+        file_size_mb = file_size / (1024 * 1024)
         logger.info(f"   ⬇️ Descargado S3: {target_key[:20]}... ({file_size_mb:.2f} MB)")
-        return True
+        return file_size
 
     except Exception as e:
         logger.debug(f"S3 Check miss o error: {e}")
-        return False
+        return None
 
 
 def extract_file_info(incident: Dict) -> Tuple[str, Optional[str], Optional[str], str]:
     file_info = {}
     
-    event_details = incident.get('event_details', {})
-    start_event = event_details.get('start_event', {})
-    source = start_event.get('source', {})
-    content = source.get('content', {})
+    event_details = incident.get('event_details') or {}
+    start_event = event_details.get('start_event') or {}
+    source = start_event.get('source') or {}
+    content = source.get('content') or {}
     
     # Prioridad 1: Objeto 'file'
     if 'file' in source:
@@ -111,8 +200,8 @@ def extract_file_info(incident: Dict) -> Tuple[str, Optional[str], Optional[str]
         # Intentar sacar hash del nombre si parece un hash
         fname = file_info['name']
         if ".txt" in fname and len(fname) > 64:
-             possible = fname.split('.')[0]
-             if len(possible) == 64: # SHA256 length
+             possible = fname.partition('.')[0]
+             if _SHA256_HEX.match(possible):
                  file_info['sha256_hash'] = possible
 
     file_name = file_info.get('name', 'unknown')
@@ -120,26 +209,24 @@ def extract_file_info(incident: Dict) -> Tuple[str, Optional[str], Optional[str]
     md5 = file_info.get('md5_hash')
     
     if file_name != 'unknown' and '.' in file_name:
-        extension = file_name.split('.')[-1]
+        extension = file_name.rpartition('.')[2]
     else:
         extension = 'bin'
     
     return file_name, sha256, md5, extension
 
 
-def extract_incident_metadata(incident: Dict) -> Dict:
+def extract_incident_metadata(incident: Dict, today: Optional[str] = None) -> Dict:
     user_info = incident.get('user', {})
     policy_info = incident.get('policy', {})
     dataset_info = incident.get('dataset', {})
     
     event_time = incident.get('event_time', '')
-    if event_time:
-        try:
-            incident_date = datetime.fromisoformat(event_time.replace('Z', '+00:00')).strftime('%Y-%m-%d')
-        except:
-            incident_date = datetime.utcnow().strftime('%Y-%m-%d')
+    # ISO-8601: los primeros 10 caracteres ya son la fecha YYYY-MM-DD
+    if event_time and len(event_time) >= 10 and event_time[4] == '-' and event_time[7] == '-':
+        incident_date = event_time[:10]
     else:
-        incident_date = datetime.utcnow().strftime('%Y-%m-%d')
+        incident_date = today or datetime.utcnow().strftime('%Y-%m-%d')
     
     return {
         'incident_id': incident.get('id'),
@@ -153,20 +240,22 @@ def extract_incident_metadata(incident: Dict) -> Dict:
 
 
 def compress_metadata_for_storage(incident: Dict) -> Dict:
-    event_details = incident.get('event_details', {})
-    start_event = event_details.get('start_event', {})
+    event_details = incident.get('event_details') or {}
+    start_event = event_details.get('start_event') or {}
+    policy = incident.get('policy') or {}
+    dataset = incident.get('dataset') or {}
     
     return {
         'id': incident.get('id'),
         'event_time': incident.get('event_time'),
         'user': incident.get('user', {}),
         'policy': {
-            'name': incident.get('policy', {}).get('name'),
-            'severity': incident.get('policy', {}).get('severity')
+            'name': policy.get('name'),
+            'severity': policy.get('severity')
         },
         'dataset': {
-            'name': incident.get('dataset', {}).get('name'),
-            'sensitivity': incident.get('dataset', {}).get('sensitivity')
+            'name': dataset.get('name'),
+            'sensitivity': dataset.get('sensitivity')
         },
         'action': start_event.get('action', {}),
         'source': start_event.get('source', {}),
@@ -175,7 +264,7 @@ def compress_metadata_for_storage(incident: Dict) -> Dict:
     }
 
 
-def process_incident(incident: Dict, base_dir: Path) -> Dict:
+def process_incident(incident: Dict, base_dir: Path, extracted: Optional[Dict] = None) -> Dict:
     incident_id = incident.get('id')
     incident_dir = base_dir / incident_id
     incident_dir.mkdir(exist_ok=True)
@@ -183,11 +272,17 @@ def process_incident(incident: Dict, base_dir: Path) -> Dict:
     # 1. Guardar metadatos (Siempre)
     metadata_path = incident_dir / "metadata.json"
     compressed_metadata = compress_metadata_for_storage(incident)
-    with open(metadata_path, 'w', encoding='utf-8') as f:
-        json.dump(compressed_metadata, f, indent=2, ensure_ascii=False)
+    # Serializamos una sola vez: los mismos bytes van al disco y a SQLite
+    metadata_blob = orjson.dumps(compressed_metadata, option=orjson.OPT_NON_STR_KEYS)
+    # Escritura atómica: un corte a mitad no deja un metadata.json truncado
+    tmp_path = metadata_path.with_name(metadata_path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(metadata_blob)
+    os.replace(tmp_path, metadata_path)
     
     file_name, sha256, md5, extension = extract_file_info(incident)
-    extracted = extract_incident_metadata(incident)
+    if extracted is None:
+        extracted = extract_incident_metadata(incident)
     
     # Detectar tipo de evento para logs inteligentes
     source_type = compressed_metadata['source'].get('type', 'unknown')
@@ -196,19 +291,21 @@ def process_incident(incident: Dict, base_dir: Path) -> Dict:
 
     file_downloaded = False
     final_file_path = None
+    file_size = 0
     
     # 2. Intentar descargar archivo S3
     if sha256:
         output_filename = file_name if file_name != 'unknown' else f"evidence.{extension}"
         output_path = incident_dir / output_filename
         
-        # Intento con SHA256 (Primary)
-        if download_from_s3(sha256, str(output_path)):
-            file_downloaded = True
-            final_file_path = str(output_path)
-        # Intento con MD5 (Fallback)
-        elif md5 and download_from_s3(md5, str(output_path)):
+        # Intento con SHA256 (Primary), luego MD5 (Fallback)
+        bytes_written = download_from_s3(sha256, str(output_path))
+        if bytes_written is None and md5:
+            bytes_written = download_from_s3(md5, str(output_path))
+        
+        if bytes_written is not None:
             file_downloaded = True
+            file_size = bytes_written
             final_file_path = str(output_path)
         else:
             # LOGGING INTELIGENTE:
@@ -224,12 +321,12 @@ def process_incident(incident: Dict, base_dir: Path) -> Dict:
         'file_name': file_name,
         'file_path': final_file_path,
         'file_type': extension,
-        'file_size': os.path.getsize(final_file_path) if final_file_path and os.path.exists(final_file_path) else 0,
+        'file_size': file_size,
         'user_email': extracted['user_email'],
         'severity': extracted['severity'],
         'policy_severity': extracted['policy_severity'],
         'incident_date': extracted['incident_date'],
-        'cyberhaven_data': compressed_metadata,
+        'cyberhaven_data': metadata_blob,
         'status': 'downloaded', # Siempre 'downloaded' para que Gemini lo procese, aunque sea solo metadata
         'has_file': file_downloaded
     }
@@ -252,7 +349,7 @@ def fetch_filtered_incidents(token: str, hours_back: int = 24, page_size: int =
     }
     
     try:
-        resp = requests.post(
+        resp = _http.post(
             f"{CYBERHAVEN_BASE_URL}/v2/incidents/list",
             headers={"Authorization": f"Bearer {token}"},
             json=payload,
@@ -276,22 +373,36 @@ def download_incidents(hours_back: int = 24, db_manager=None) -> List[Dict]:
     processed = []
     logger.info(f"Procesando {len(incidents)} incidentes HIGH/CRITICAL...")
     
-    for inc in incidents:
-        incident_id = inc.get('id')
-        
-        if db_manager and db_manager.incident_exists(incident_id):
-            continue
-        
-        extracted = extract_incident_metadata(inc)
-        date_dir = get_date_directory(extracted['incident_date'])
-        
-        # Proceso principal
-        result = process_incident(inc, date_dir)
-        
-        if db_manager:
-            db_manager.insert_incident(result)
+    # Fecha de respaldo y directorios por fecha resueltos una vez por ciclo
+    today = datetime.utcnow().strftime('%Y-%m-%d')
+    date_dirs: Dict[str, Path] = {}
+    
+    # Una sola consulta para descartar los ya ingestados
+    existing_ids = db_manager.get_existing_incident_ids([inc.get('id') for inc in incidents]) if db_manager else set()
+    
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        futures = []
+        for inc in incidents:
+            if inc.get('id') in existing_ids:
+                continue
+            
+            extracted = extract_incident_metadata(inc, today)
+            date_dir = date_dirs.get(extracted['incident_date'])
+            if date_dir is None:
+                date_dir = date_dirs[extracted['incident_date']] = get_date_directory(extracted['incident_date'])
+            
+            # Proceso principal (descargas S3 en paralelo)
+            futures.append(executor.submit(process_incident, inc, date_dir, extracted))
         
-        processed.append(result)
+        for future in as_completed(futures):
+            try:
+                processed.append(future.result())
+            except Exception as e:
+                logger.error(f"Error procesando incidente: {e}")
+    
+    # Una sola transacción para todo el lote
+    if db_manager and processed:
+        db_manager.insert_incidents_bulk(processed)
     
     if processed:
         logger.info(f"✅ Ciclo completado: {len(processed)} nuevos incidentes ingestados.")
@@ -299,4 +410,15 @@ def download_incidents(hours_back: int = 24, db_manager=None) -> List[Dict]:
     return processed
 
 if __name__ == "__main__":
-    download_incidents()
\ No newline at end of file
+    if sys.stdout.isatty():
+        download_incidents()
+    else:
+        # Modo filtro: solo warnings por stderr y la lista procesada como JSON por stdout
+        logger.setLevel(logging.WARNING)
+        processed = download_incidents()
+        for item in processed:
+            # cyberhaven_data ya son bytes JSON: se incrustan sin volver a serializar
+            if isinstance(item.get('cyberhaven_data'), bytes):
+                item['cyberhaven_data'] = orjson.Fragment(item['cyberhaven_data'])
+        sys.stdout.buffer.write(orjson.dumps(processed))
+        sys.stdout.buffer.write(b"\n")
\ No newline at end of file
@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 import os
 import sys
+import atexit
 from datetime import datetime
 from pathlib import Path
 
+import orjson
+
 from rich.console import Console
 from rich.table import Table
 from rich.panel import Panel
@@ -17,56 +20,37 @@ BASE_INCIDENTS_DIR = os.getenv("INCIDENTS_DIR", "./data/incidents")
 
 
 def clear():
-    console.clear()
+    if console.is_terminal:
+        console.clear()
 
 
-def print_header():
-    console.print(Panel(
-        "[bold cyan]CYBER-TRIAGE[/bold cyan] | [white]Revisión de Análisis[/white]",
-        style="blue"
-    ))
-    console.print()
+HEADER = Panel(
+    "[bold cyan]CYBER-TRIAGE[/bold cyan] | [white]Revisión de Análisis[/white]",
+    style="blue"
+)
 
 
-def get_analyzed_incidents(db: DatabaseManager, date: str = None, limit: int = 20):
-    conn = db._get_connection()
-    cursor = conn.cursor()
-    try:
-        if date:
-            cursor.execute('''
-                SELECT i.*, a.gemini_verdict, a.gemini_confidence, a.executive_summary, 
-                       a.risk_level, a.id as analysis_id
-                FROM incidents i
-                JOIN analysis a ON i.incident_id = a.incident_id
-                WHERE i.incident_date = ?
-                ORDER BY a.created_at DESC
-                LIMIT ?
-            ''', (date, limit))
-        else:
-            cursor.execute('''
-                SELECT i.*, a.gemini_verdict, a.gemini_confidence, a.executive_summary,
-                       a.risk_level, a.id as analysis_id
-                FROM incidents i
-                JOIN analysis a ON i.incident_id = a.incident_id
-                ORDER BY a.created_at DESC
-                LIMIT ?
-            ''', (limit,))
-        return [dict(row) for row in cursor.fetchall()]
-    finally:
-        conn.close()
+def print_header():
+    if not console.is_terminal:
+        return
+    console.print(HEADER)
+    console.print()
 
 
-def has_feedback(db: DatabaseManager, incident_id: str) -> bool:
-    conn = db._get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('SELECT 1 FROM feedback WHERE incident_id = ? LIMIT 1', (incident_id,))
-        return cursor.fetchone() is not None
-    finally:
-        conn.close()
+def build_main_menu():
+    menu = Table(box=box.SIMPLE, show_header=False)
+    menu.add_column(style="cyan", width=4)
+    menu.add_column(style="white")
+    
+    menu.add_row("1", "📋 Ver incidentes de HOY")
+    menu.add_row("2", "📅 Ver incidentes por fecha")
+    menu.add_row("3", "🕐 Ver últimos 20 analizados")
+    menu.add_row("4", "📊 Ver estadísticas")
+    menu.add_row("0", "🚪 Salir")
+    return menu
 
 
-def display_incident_list(incidents, db):
+def build_incident_table(incidents, db):
     table = Table(title="Incidentes Analizados", box=box.SIMPLE_HEAD, expand=True)
     table.add_column("#", style="cyan", width=4)
     table.add_column("Fecha", style="blue", width=12)
@@ -76,6 +60,8 @@ def display_incident_list(incidents, db):
     table.add_column("Riesgo", width=10)
     table.add_column("Revisado", width=8)
     
+    reviewed_ids = db.get_incident_ids_with_feedback([inc['incident_id'] for inc in incidents])
+    
     for idx, inc in enumerate(incidents, 1):
         verdict = inc.get('gemini_verdict', '?')
         confidence = inc.get('gemini_confidence', 0)
@@ -83,7 +69,7 @@ def display_incident_list(incidents, db):
         
         verdict_color = {'TRUE_POSITIVE': 'red', 'FALSE_POSITIVE': 'green', 'REQUIRES_REVIEW': 'yellow'}.get(verdict, 'white')
         
-        reviewed = "✓" if has_feedback(db, inc['incident_id']) else ""
+        reviewed = "✓" if inc['incident_id'] in reviewed_ids else ""
         
         table.add_row(
             str(idx),
@@ -95,8 +81,12 @@ def display_incident_list(incidents, db):
             f"[green]{reviewed}[/green]"
         )
     
+    return table
+
+
+def display_incident_list(table, total):
     console.print(table)
-    console.print(f"\n[dim]Total: {len(incidents)} incidentes[/dim]\n")
+    console.print(f"\n[dim]Total: {total} incidentes[/dim]\n")
 
 
 def display_incident_detail(inc, db):
@@ -136,14 +126,12 @@ def display_incident_detail(inc, db):
     analysis_file = incident_dir / "analysis_result.json"
     
     if analysis_file.exists():
-        import json
-        with open(analysis_file, 'r') as f:
-            analysis = json.load(f)
+        analysis = orjson.loads(analysis_file.read_bytes())
         reasoning = analysis.get('reasoning', 'Sin razonamiento')
         console.print(Panel(reasoning, title="[bold]Razonamiento Técnico[/bold]", border_style="dim"))
         console.print()
     
-    reviewed = has_feedback(db, inc['incident_id'])
+    reviewed = db.has_feedback(inc['incident_id'])
     if reviewed:
         console.print("[green]✓ Este incidente ya fue revisado[/green]\n")
 
@@ -162,8 +150,10 @@ def collect_feedback(inc, db):
             'analyst_comment': 'Confirmado por analista',
             'relevance_score': 1.0
         }
-        db.insert_feedback(feedback_data)
-        console.print("[green]✅ Feedback guardado (Confirmado)[/green]")
+        if not db.insert_feedback(feedback_data):
+            console.print("[red]Error guardando feedback[/red]")
+            return False
+        console.print("[green]✅ Feedback registrado (Confirmado)[/green]")
         return True
     
     console.print("\n[bold]Seleccione el veredicto correcto:[/bold]")
@@ -192,8 +182,10 @@ def collect_feedback(inc, db):
         'relevance_score': 1.0
     }
     
-    db.insert_feedback(feedback_data)
-    console.print(f"[green]✅ Feedback guardado: {current_verdict} → {corrected}[/green]")
+    if not db.insert_feedback(feedback_data):
+        console.print("[red]Error guardando feedback[/red]")
+        return False
+    console.print(f"[green]✅ Feedback registrado: {current_verdict} → {corrected}[/green]")
     return True
 
 
@@ -232,21 +224,13 @@ def show_stats(db):
 
 def main_menu():
     db = DatabaseManager()
+    atexit.register(db.close)
+    menu = build_main_menu()
     
     while True:
         clear()
         print_header()
         
-        menu = Table(box=box.SIMPLE, show_header=False)
-        menu.add_column(style="cyan", width=4)
-        menu.add_column(style="white")
-        
-        menu.add_row("1", "📋 Ver incidentes de HOY")
-        menu.add_row("2", "📅 Ver incidentes por fecha")
-        menu.add_row("3", "🕐 Ver últimos 20 analizados")
-        menu.add_row("4", "📊 Ver estadísticas")
-        menu.add_row("0", "🚪 Salir")
-        
         console.print(menu)
         console.print()
         
@@ -258,14 +242,14 @@ def main_menu():
         
         elif choice == "1":
             today = datetime.now().strftime('%Y-%m-%d')
-            incidents = get_analyzed_incidents(db, date=today)
+            incidents = db.get_analyzed_incidents(date=today)
             
         elif choice == "2":
             date_input = Prompt.ask("Fecha (YYYY-MM-DD)", default=datetime.now().strftime('%Y-%m-%d'))
-            incidents = get_analyzed_incidents(db, date=date_input)
+            incidents = db.get_analyzed_incidents(date=date_input)
             
         elif choice == "3":
-            incidents = get_analyzed_incidents(db, limit=20)
+            incidents = db.get_analyzed_incidents(limit=20)
             
         elif choice == "4":
             show_stats(db)
@@ -277,10 +261,13 @@ def main_menu():
                 Prompt.ask("[dim]Enter para continuar[/dim]")
                 continue
             
+            # La tabla solo se reconstruye cuando cambia el estado de revisión
+            table = build_incident_table(incidents, db)
+            
             while True:
                 clear()
                 print_header()
-                display_incident_list(incidents, db)
+                display_incident_list(table, len(incidents))
                 
                 console.print("[bold]Opciones:[/bold]")
                 console.print("1-N  Ver detalle y dar feedback")
@@ -294,7 +281,8 @@ def main_menu():
                 if sel.isdigit() and 1 <= int(sel) <= len(incidents):
                     selected = incidents[int(sel) - 1]
                     display_incident_detail(selected, db)
-                    collect_feedback(selected, db)
+                    if collect_feedback(selected, db):
+                        table = build_incident_table(incidents, db)
                     Prompt.ask("[dim]Enter para continuar[/dim]")
 
 
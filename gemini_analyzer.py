@@ -1,12 +1,21 @@
 import os
-import json
+import orjson
 import time
-from typing import Dict, Optional, List, Union
+import asyncio
+import hashlib
+import io
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor, Future
+from typing import Dict, Optional, List, Union, TYPE_CHECKING
 from pathlib import Path
 import logging
 import google.generativeai as genai
 from db_manager import DatabaseManager
-import PIL.Image
+
+if TYPE_CHECKING:
+    import PIL.Image
 
 logging.basicConfig(
     level=logging.INFO,
@@ -14,13 +23,120 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+PROMPT_VERSION = "v2"
+CACHE_TTL_DAYS = 7
+RESPONSE_MEMORY_CACHE_SIZE = 512
+IMAGE_MAX_EDGE = 1536
+IMAGE_JPEG_QUALITY = 85
+# Dict vacío compartido para los .get() encadenados; nunca se modifica
+_EMPTY = {}
+
+# Esquema y configuración de generación compartidos por todas las instancias
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "v": {
+            "type": "string",
+            "enum": ["TP", "FP", "RR"],
+            "description": "TP=True Positive, FP=False Positive, RR=Requires Review"
+        },
+        "c": {
+            "type": "number",
+            "description": "Confidence 0.0-1.0"
+        },
+        "s": {
+            "type": "string",
+            "description": "Executive summary in Spanish"
+        },
+        "ctx": {
+            "type": "object",
+            "properties": {
+                "u": {"type": "string"},
+                "src": {"type": "string"},
+                "dst": {"type": "string"},
+                "dt": {"type": "string"}
+            }
+        },
+        "r": {
+            "type": "string",
+            "description": "Technical reasoning"
+        },
+        "rl": {
+            "type": "string",
+            "enum": ["C", "H", "M", "L", "N"],
+            "description": "C=Critical, H=High, M=Medium, L=Low, N=N/A"
+        },
+        "ind": {
+            "type": "array",
+            "items": {"type": "string"}
+        }
+    },
+    "required": ["v", "c", "s", "ctx", "r", "rl"]
+}
+
+GENERATION_CONFIG = {
+    "temperature": 0.2,
+    "response_mime_type": "application/json",
+    "response_schema": RESPONSE_SCHEMA
+}
+# Reintento ante respuestas fuera de esquema: algo más de temperatura para no repetir la misma salida
+RETRY_GENERATION_CONFIG = {**GENERATION_CONFIG, "temperature": 0.3}
+
+VERDICT_NAMES = {"TP": "TRUE_POSITIVE", "FP": "FALSE_POSITIVE", "RR": "REQUIRES_REVIEW"}
+RISK_LEVEL_NAMES = {"C": "CRITICAL", "H": "HIGH", "M": "MEDIUM", "L": "LOW", "N": "N/A"}
+
+_VALID_VERDICTS = frozenset(RESPONSE_SCHEMA["properties"]["v"]["enum"])
+_VALID_RISK_LEVELS = frozenset(RESPONSE_SCHEMA["properties"]["rl"]["enum"])
+
+
+def _is_valid_response(compact) -> bool:
+    # Comprobación directa de los campos obligatorios del esquema, sin validador genérico
+    return (
+        isinstance(compact, dict)
+        and compact.get('v') in _VALID_VERDICTS
+        and isinstance(compact.get('c'), (int, float))
+        and isinstance(compact.get('s'), str)
+        and isinstance(compact.get('ctx'), dict)
+        and isinstance(compact.get('r'), str)
+        and compact.get('rl') in _VALID_RISK_LEVELS
+        and isinstance(compact.get('ind', []), list)
+    )
+
+# Lector por extensión: un solo lookup en lugar de recorrer listas con if/elif
+_FILE_READERS = {ext: "_read_text_file" for ext in ('.txt', '.md', '.py', '.json', '.xml', '.csv', '.log', '.sql')}
+_FILE_READERS.update({ext: "_prepare_image" for ext in ('.png', '.jpg', '.jpeg', '.webp')})
+_FILE_READERS.update({'.pdf': "_read_pdf_text", '.xlsx': "_read_xlsx_text", '.xlsm': "_read_xlsx_text"})
+_READER_ERRORS = {'.pdf': "[Error leyendo PDF]", '.xlsx': "[Error leyendo Excel]", '.xlsm': "[Error leyendo Excel]"}
+
+# --- LÓGICA PARA CASOS SIN ARCHIVO ---
+NO_EVIDENCE_INSTRUCTIONS = (
+    "\n\n[⚠️ ALERTA: EVIDENCIA NO DISPONIBLE]\n"
+    "CONTEXTO: Este incidente es de tipo 'Metadatos', el archivo no fue capturado por la política.\n"
+    "INSTRUCCIONES CRÍTICAS:\n"
+    "1. NO intentes adivinar el contenido del archivo.\n"
+    "2. Juzga el riesgo basándote ÚNICAMENTE en la combinación Usuario + Destino + Nombre del Archivo/Asunto.\n"
+    "3. Si el destino es un email personal pero el nombre del archivo/asunto parece inofensivo (recibos, tareas escolares, citas médicas), clasifícalo como FALSE POSITIVE (FP).\n"
+    "4. Solo marca RR o TP si el nombre del archivo sugiere explícitamente datos confidenciales (ej. 'passwords.txt', 'clientes.xlsx')."
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_prompt_file(prompt_path: str) -> Optional[str]:
+    # El prompt no cambia durante la vida del proceso: se lee una sola vez
+    try:
+        with open(prompt_path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
 
 class GeminiAnalyzer:
     def __init__(
         self, 
         api_key: Optional[str] = None,
         db_manager: Optional[DatabaseManager] = None,
-        model_name: str = "gemini-2.0-flash"
+        model_name: str = "gemini-2.0-flash",
+        use_cache: bool = True
     ):
         self.api_key = api_key or os.getenv("GEMINI_API_KEY")
         if not self.api_key:
@@ -28,81 +144,61 @@ class GeminiAnalyzer:
         
         genai.configure(api_key=self.api_key)
         self.model_name = model_name
+        self.use_cache = use_cache
         self.db = db_manager or DatabaseManager()
         self.system_prompt = self._load_system_prompt()
+        self._rag_cache = {}
+        self._rag_lock = threading.Lock()
+        self._response_memo = OrderedDict()
+        self._response_memo_lock = threading.Lock()
+        self._inflight = {}
         
-        self.response_schema = {
-            "type": "object",
-            "properties": {
-                "v": {
-                    "type": "string",
-                    "enum": ["TP", "FP", "RR"],
-                    "description": "TP=True Positive, FP=False Positive, RR=Requires Review"
-                },
-                "c": {
-                    "type": "number",
-                    "description": "Confidence 0.0-1.0"
-                },
-                "s": {
-                    "type": "string",
-                    "description": "Executive summary in Spanish"
-                },
-                "ctx": {
-                    "type": "object",
-                    "properties": {
-                        "u": {"type": "string"},
-                        "src": {"type": "string"},
-                        "dst": {"type": "string"},
-                        "dt": {"type": "string"}
-                    }
-                },
-                "r": {
-                    "type": "string",
-                    "description": "Technical reasoning"
-                },
-                "rl": {
-                    "type": "string",
-                    "enum": ["C", "H", "M", "L", "N"],
-                    "description": "C=Critical, H=High, M=Medium, L=Low, N=N/A"
-                },
-                "ind": {
-                    "type": "array",
-                    "items": {"type": "string"}
-                }
-            },
-            "required": ["v", "c", "s", "ctx", "r", "rl"]
-        }
+        self.response_schema = RESPONSE_SCHEMA
+        
+        # Modelo y system prompt son invariantes: se construyen una sola vez
+        self._model = genai.GenerativeModel(
+            model_name=self.model_name,
+            generation_config=GENERATION_CONFIG,
+            system_instruction=self.system_prompt
+        )
         
         logger.info(f"GeminiAnalyzer inicializado: {model_name}")
     
     def _load_system_prompt(self) -> str:
-        prompt_path = Path("./prompts/system_prompt.md")
-        try:
-            with open(prompt_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        except FileNotFoundError:
-            return self._get_default_prompt()
+        return _read_prompt_file("./prompts/system_prompt.md") or self._get_default_prompt()
     
     def _get_default_prompt(self) -> str:
         return """Eres un analista DLP. Evalúa incidentes y responde JSON."""
 
     def _build_rag_context(self, limit: int = 3) -> str:
+        # Solo se reconsulta la DB si entró feedback desde la última vez
+        key = (limit, self.db.feedback_version())
+        # Varios hilos de _analyze_batch comparten esta caché
+        with self._rag_lock:
+            rag = self._rag_cache.get(key)
+            if rag is None:
+                rag = self._rag_cache[key] = self._query_rag_context(limit)
+                if len(self._rag_cache) > 4:
+                    self._rag_cache.pop(next(iter(self._rag_cache)))
+        return rag
+
+    def _query_rag_context(self, limit: int) -> str:
         feedback_items = self.db.get_feedback_for_rag(limit=limit)
         if not feedback_items:
             return ""
         
-        rag = "\n[HISTORIAL DE CORRECCIONES HUMANAS]\n"
+        lines = ["\n[HISTORIAL DE CORRECCIONES HUMANAS]\n"]
         for fb in feedback_items:
-            rag += f"- Archivo {fb.get('file_type','?')}: La IA dijo {fb['original_verdict']} pero el Humano corrigió a {fb['corrected_verdict']}. Nota: {fb.get('analyst_comment', '')[:100]}\n"
-        return rag
+            lines.append(f"- Archivo {fb.get('file_type','?')}: La IA dijo {fb['original_verdict']} pero el Humano corrigió a {fb['corrected_verdict']}. Nota: {fb.get('analyst_comment', '')[:100]}\n")
+        return "".join(lines)
     
     def _compress_metadata(self, metadata: Dict) -> str:
-        user = metadata.get('user', {}).get('id', 'unknown')
-        policy = metadata.get('policy', {})
+        user = metadata.get('user', _EMPTY).get('id', 'unknown')
+        policy = metadata.get('policy', _EMPTY)
         
-        event = metadata.get('action', {})
-        src = metadata.get('source', {})
-        dst = metadata.get('destination', {})
+        event = metadata.get('action', _EMPTY)
+        src = metadata.get('source', _EMPTY)
+        dst = metadata.get('destination', _EMPTY)
         
         src_str = "?"
         if 'app' in src: src_str = src['app'].get('name', '?')
@@ -120,7 +216,7 @@ class GeminiAnalyzer:
         elif 'removable_media' in dst:
             dst_str = "USB Device"
         
-        snippet = metadata.get('content_inspection', {}).get('snippet', '')[:300]
+        snippet = metadata.get('content_inspection', _EMPTY).get('snippet', '')[:300]
         
         compressed = f"""
 USUARIO: {user}
@@ -135,41 +231,90 @@ TIPO: {src.get('type', '?')} -> {dst.get('type', '?')}
         
         return compressed
     
-    def _read_file_content(self, file_path: str, max_chars: int = 15000) -> Union[str, PIL.Image.Image]:
-        try:
-            path_obj = Path(file_path)
-            ext = path_obj.suffix.lower()
-            
-            if ext in ['.png', '.jpg', '.jpeg', '.webp']:
-                return PIL.Image.open(file_path)
-
-            if ext in ['.txt', '.md', '.py', '.json', '.xml', '.csv', '.log', '.sql']:
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    return f.read()[:max_chars]
-            
-            elif ext == '.pdf':
-                try:
-                    import PyPDF2
-                    with open(file_path, 'rb') as f:
-                        reader = PyPDF2.PdfReader(f)
-                        text = ""
-                        for page in reader.pages[:10]:
-                            text += page.extract_text() or ""
-                        return text[:max_chars]
-                except: return "[Error leyendo PDF]"
-            
+    def _read_file_content(self, file_path: str, max_chars: int = 15000) -> Union[str, "PIL.Image.Image", Dict]:
+        ext = Path(file_path).suffix.lower()
+        reader = _FILE_READERS.get(ext)
+        if reader is None:
             return f"[Contenido binario no extraído para {ext}]"
         
+        try:
+            return getattr(self, reader)(file_path, max_chars)
         except Exception as e:
-            return f"[Error leyendo archivo: {e}]"
+            return _READER_ERRORS.get(ext) or f"[Error leyendo archivo: {e}]"
     
-    def _expand_response(self, compact: Dict) -> Dict:
-        verdict_map = {"TP": "TRUE_POSITIVE", "FP": "FALSE_POSITIVE", "RR": "REQUIRES_REVIEW"}
-        risk_map = {"C": "CRITICAL", "H": "HIGH", "M": "MEDIUM", "L": "LOW", "N": "N/A"}
+    def _read_text_file(self, file_path: str, max_chars: int) -> str:
+        # Lectura acotada en bytes (hasta 4 por carácter UTF-8) y un único decode: no carga logs enormes completos
+        with open(file_path, 'rb') as f:
+            return f.read(max_chars * 4).decode('utf-8', errors='ignore')[:max_chars]
+    
+    def _prepare_image(self, file_path: str, max_chars: int = 0) -> Union["PIL.Image.Image", Dict]:
+        # Pillow solo se importa cuando aparece una imagen como evidencia
+        import PIL.Image
+        import PIL.ImageChops
+        
+        img = PIL.Image.open(file_path)
+        if max(img.size) <= IMAGE_MAX_EDGE:
+            return img
+        
+        if img.format == "JPEG":
+            # libjpeg decodifica directamente a escala reducida (1/2, 1/4, 1/8) sin pasar por la resolución completa
+            img.draft("RGB", (IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
         
-        ctx = compact.get('ctx', {})
+        # Gemini reescala de todas formas: se reduce antes para no subir fotos de muchos megapíxeles
+        img.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), PIL.Image.LANCZOS)
+        # Escala de grises en un solo canal: sin pérdida de información y, al ir como blob JPEG, menos bytes subidos
+        if img.mode in ("1", "L", "LA", "I", "I;16", "F"):
+            img = img.convert("L")
+        else:
+            img = img.convert("RGB")
+            r, g, b = img.split()
+            if PIL.ImageChops.difference(r, g).getbbox() is None and PIL.ImageChops.difference(g, b).getbbox() is None:
+                img = img.convert("L")
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+        # Blob explícito: con una imagen PIL en memoria el SDK reencodaría los píxeles a WebP sin pérdida
+        return {"mime_type": "image/jpeg", "data": buf.getvalue()}
+    
+    def _read_xlsx_text(self, file_path: str, max_chars: int) -> str:
+        # read_only recorre las filas en streaming sin cargar el libro entero en memoria
+        import openpyxl
+        
+        wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            lines = []
+            total = 0
+            for row in wb.worksheets[0].iter_rows(values_only=True):
+                line = "\t".join("" if v is None else str(v) for v in row)
+                lines.append(line)
+                total += len(line) + 1
+                if total >= max_chars:
+                    break
+            return "\n".join(lines)[:max_chars]
+        finally:
+            wb.close()
+    
+    def _read_pdf_text(self, file_path: str, max_chars: int, max_pages: int = 10) -> str:
+        # pypdfium2 (PDFium nativo) libera el GIL y es mucho más rápido que un parser en Python puro
+        import pypdfium2 as pdfium
+        
+        chunks = []
+        total = 0
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            for i in range(min(len(pdf), max_pages)):
+                page_text = pdf[i].get_textpage().get_text_range()
+                chunks.append(page_text)
+                total += len(page_text)
+                if total >= max_chars:
+                    break
+        finally:
+            pdf.close()
+        return "".join(chunks)[:max_chars]
+    
+    def _expand_response(self, compact: Dict) -> Dict:
+        ctx = compact.get('ctx', _EMPTY)
         return {
-            'verdict': verdict_map.get(compact.get('v'), compact.get('v')),
+            'verdict': VERDICT_NAMES.get(compact.get('v'), compact.get('v')),
             'confidence': compact.get('c', 0),
             'executive_summary': compact.get('s', ''),
             'incident_context': {
@@ -179,80 +324,237 @@ TIPO: {src.get('type', '?')} -> {dst.get('type', '?')}
                 'data_type': ctx.get('dt', '')
             },
             'reasoning': compact.get('r', ''),
-            'risk_level': risk_map.get(compact.get('rl'), compact.get('rl')),
+            'risk_level': RISK_LEVEL_NAMES.get(compact.get('rl'), compact.get('rl')),
             'indicators': compact.get('ind', [])
         }
     
-    def analyze_incident(self, incident_id: str, incident_dir: Path, use_rag: bool = True) -> Dict:
+    def _build_prompt_parts(self, metadata: Dict, file_name: Optional[str], file_content, use_rag: bool) -> List:
+        # Fragmentos en lista y un único join: evita copiar el prompt completo en cada +=
+        prompt_parts = []
+        text_parts = []
+        
+        if use_rag:
+            rag = self._build_rag_context(limit=3)
+            if rag: text_parts.append(rag + "\n")
+        
+        text_parts.append("[INCIDENTE A ANALIZAR]\n")
+        text_parts.append(self._compress_metadata(metadata))
+        
+        if file_content:
+            text_parts.append(f"\n\n[EVIDENCIA DISPONIBLE: {file_name}]\n")
+            if not isinstance(file_content, str):
+                prompt_parts.append("".join(text_parts))
+                prompt_parts.append(file_content)
+                text_parts = ["\n[Instrucción: Analiza la imagen buscando datos sensibles visuales]\n"]
+            else:
+                text_parts.append(str(file_content))
+        else:
+            text_parts.append(NO_EVIDENCE_INSTRUCTIONS)
+
+        text_parts.append("\n\nResponde estrictamente en formato JSON.")
+        prompt_parts.append("".join(text_parts))
+        return prompt_parts
+    
+    def _scan_incident_files(self, incident_dir: Path) -> List[os.DirEntry]:
+        # Una sola pasada por el directorio; DirEntry cachea el tipo de archivo.
+        # Los .tmp son escrituras atómicas interrumpidas, no evidencia
+        with os.scandir(incident_dir) as entries:
+            files = [
+                e for e in entries
+                if e.name != "analysis_result.json" and not e.name.endswith(".tmp") and e.is_file(follow_symlinks=False)
+            ]
+        files.sort(key=lambda e: e.name)
+        return files
+    
+    def _file_digests(self, files: List[os.DirEntry]) -> Dict[str, bytes]:
+        digests = {}
+        for entry in files:
+            with open(entry.path, 'rb') as f:
+                digests[entry.name] = hashlib.file_digest(f, "sha256").digest()
+        return digests
+    
+    def _incident_digest(self, file_digests: Dict[str, bytes], use_rag: bool) -> str:
+        # Clave de caché: contenido del incidente + versión del prompt + modelo + bloque RAG que verá el modelo.
+        # Se hashea el texto RAG (no un contador) para que la clave sobreviva a reinicios del proceso
+        rag = self._build_rag_context(limit=3) if use_rag else None
+        digest = hashlib.sha256(f"{PROMPT_VERSION}|{self.model_name}|{self.system_prompt}|{rag}".encode('utf-8'))
+        for name, file_digest in file_digests.items():
+            digest.update(name.encode('utf-8'))
+            digest.update(file_digest)
+        return digest.hexdigest()
+    
+    def _prompt_digest(self, prompt_parts: List, evidence_digest: Optional[bytes]) -> str:
+        # Clave por prompt final: incidentes distintos con el mismo contenido comparten respuesta
+        digest = hashlib.sha256(f"prompt|{PROMPT_VERSION}|{self.model_name}|{self.system_prompt}".encode('utf-8'))
+        for part in prompt_parts:
+            if isinstance(part, str):
+                digest.update(part.encode('utf-8'))
+            else:
+                digest.update(evidence_digest or b'')
+        return digest.hexdigest()
+    
+    def _get_cached_response(self, key: str) -> Optional[str]:
+        # Primer nivel en memoria (LRU) para los duplicados del mismo proceso; SQLite como segundo nivel
+        with self._response_memo_lock:
+            raw = self._response_memo.get(key)
+            if raw is not None:
+                self._response_memo.move_to_end(key)
+                return raw
+        
+        raw = self.db.get_cached_response(key, CACHE_TTL_DAYS)
+        if raw is not None:
+            self._remember_response(key, raw)
+        return raw
+    
+    def _store_cached_response(self, key: str, raw_response: str):
+        self.db.store_cached_response(key, self.model_name, raw_response)
+        self._remember_response(key, raw_response)
+    
+    def _remember_response(self, key: str, raw_response: str):
+        with self._response_memo_lock:
+            self._response_memo[key] = raw_response
+            self._response_memo.move_to_end(key)
+            if len(self._response_memo) > RESPONSE_MEMORY_CACHE_SIZE:
+                self._response_memo.popitem(last=False)
+    
+    def load_incident_inputs(self, incident_dir: Path, use_rag: bool = True) -> Optional[Dict]:
+        """Lee metadata, clave de caché y evidencia; separado para poder adelantarlo a la llamada a Gemini."""
+        files = self._scan_incident_files(incident_dir)
+        if not any(entry.name == "metadata.json" for entry in files):
+            return None
+        
+        metadata = orjson.loads((incident_dir / "metadata.json").read_bytes())
+        
+        evidence = next((entry for entry in files if entry.name != "metadata.json"), None)
+        
+        cache_key = None
+        cached_response = None
+        evidence_digest = None
+        if self.use_cache:
+            file_digests = self._file_digests(files)
+            cache_key = self._incident_digest(file_digests, use_rag)
+            cached_response = self._get_cached_response(cache_key)
+            evidence_digest = file_digests.get(evidence.name) if evidence else None
+        
+        file_content = None
+        if evidence and cached_response is None:
+            file_content = self._read_file_content(evidence.path)
+        
+        return {
+            'metadata': metadata,
+            'cache_key': cache_key,
+            'cached_response': cached_response,
+            'evidence_digest': evidence_digest,
+            'file_name': evidence.name if evidence else None,
+            'file_content': file_content
+        }
+    
+    def _generate(self, prompt_parts: List, generation_config: Optional[Dict] = None):
+        response = self._model.generate_content(prompt_parts, generation_config=generation_config)
+        tokens_used = 0
+        if hasattr(response, 'usage_metadata'):
+            tokens_used = getattr(response.usage_metadata, 'total_token_count', 0)
+        return response.text, tokens_used
+    
+    def _generate_validated(self, prompt_parts: List, incident_id: str):
+        raw_response, tokens_used = self._generate(prompt_parts)
+        compact = self._parse_response(raw_response)
+        if compact is None:
+            logger.warning(f"Respuesta fuera de esquema para {incident_id}, reintentando")
+            raw_response, retry_tokens = self._generate(prompt_parts, RETRY_GENERATION_CONFIG)
+            tokens_used += retry_tokens
+            compact = self._parse_response(raw_response)
+        return raw_response, compact, tokens_used
+    
+    def _generate_coalesced(self, prompt_key: str, prompt_parts: List, incident_id: str):
+        """Una sola llamada a Gemini por prompt_key: los duplicados concurrentes esperan al primero."""
+        # Devuelve (raw, compact, tokens, shared); con shared=True compact va en None y lo parsea el llamador
+        with self._response_memo_lock:
+            # El líder guarda en memoria antes de salir de _inflight: si ya terminó, está aquí
+            raw = self._response_memo.get(prompt_key)
+            if raw is not None:
+                return raw, None, 0, True
+            pending = self._inflight.get(prompt_key)
+            leader = pending is None
+            if leader:
+                pending = self._inflight[prompt_key] = Future()
+        
+        if not leader:
+            try:
+                raw = pending.result()
+            except Exception:
+                raw = None
+            if raw is not None:
+                return raw, None, 0, True
+            # La llamada del líder falló: este incidente lo intenta por su cuenta
+            raw, compact, tokens_used = self._generate_validated(prompt_parts, incident_id)
+            if compact is not None:
+                self._store_cached_response(prompt_key, raw)
+            return raw, compact, tokens_used, False
+        
+        try:
+            raw, compact, tokens_used = self._generate_validated(prompt_parts, incident_id)
+            if compact is not None:
+                self._store_cached_response(prompt_key, raw)
+            pending.set_result(raw if compact is not None else None)
+            return raw, compact, tokens_used, False
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._response_memo_lock:
+                self._inflight.pop(prompt_key, None)
+    
+    def _parse_response(self, raw_response: str) -> Optional[Dict]:
+        try:
+            compact = orjson.loads(raw_response)
+        except orjson.JSONDecodeError:
+            return None
+        return compact if _is_valid_response(compact) else None
+    
+    def analyze_incident(self, incident_id: str, incident_dir: Path, use_rag: bool = True, inputs: Optional[Dict] = None, persist: bool = True) -> Dict:
         start_time = time.time()
         
         try:
-            metadata_path = incident_dir / "metadata.json"
-            if not metadata_path.exists():
+            if inputs is None:
+                inputs = self.load_incident_inputs(incident_dir, use_rag)
+            if inputs is None:
                 return {"success": False, "error": "metadata.json no encontrado"}
             
-            with open(metadata_path, 'r', encoding='utf-8') as f:
-                metadata = json.load(f)
-            
-            file_content = None
-            file_name = None
-            
-            for file in incident_dir.iterdir():
-                if file.name not in ["metadata.json", "analysis_result.json"] and file.is_file():
-                    file_name = file.name
-                    file_content = self._read_file_content(str(file))
-                    break
-            
-            prompt_parts = []
-            text_prompt = self.system_prompt + "\n\n"
-            
-            if use_rag:
-                rag = self._build_rag_context(limit=3)
-                if rag: text_prompt += rag + "\n"
-            
-            text_prompt += "[INCIDENTE A ANALIZAR]\n"
-            text_prompt += self._compress_metadata(metadata)
+            cache_key = inputs['cache_key']
+            raw_response = inputs['cached_response']
+            cache_hit = raw_response is not None
+            file_name = inputs['file_name']
+            tokens_used = 0
             
-            if file_content:
-                text_prompt += f"\n\n[EVIDENCIA DISPONIBLE: {file_name}]\n"
-                if isinstance(file_content, PIL.Image.Image):
-                    prompt_parts.append(text_prompt)
-                    prompt_parts.append(file_content)
-                    text_prompt = "\n[Instrucción: Analiza la imagen buscando datos sensibles visuales]\n"
-                else:
-                    text_prompt += str(file_content)
-            else:
-                # --- NUEVA LÓGICA PARA CASOS SIN ARCHIVO ---
-                text_prompt += "\n\n[⚠️ ALERTA: EVIDENCIA NO DISPONIBLE]\n"
-                text_prompt += "CONTEXTO: Este incidente es de tipo 'Metadatos', el archivo no fue capturado por la política.\n"
-                text_prompt += "INSTRUCCIONES CRÍTICAS:\n"
-                text_prompt += "1. NO intentes adivinar el contenido del archivo.\n"
-                text_prompt += "2. Juzga el riesgo basándote ÚNICAMENTE en la combinación Usuario + Destino + Nombre del Archivo/Asunto.\n"
-                text_prompt += "3. Si el destino es un email personal pero el nombre del archivo/asunto parece inofensivo (recibos, tareas escolares, citas médicas), clasifícalo como FALSE POSITIVE (FP).\n"
-                text_prompt += "4. Solo marca RR o TP si el nombre del archivo sugiere explícitamente datos confidenciales (ej. 'passwords.txt', 'clientes.xlsx')."
-
-            text_prompt += "\n\nResponde estrictamente en formato JSON."
-            prompt_parts.append(text_prompt)
+            prompt_key = None
+            compact_result = None
             
-            model = genai.GenerativeModel(
-                model_name=self.model_name,
-                generation_config={
-                    "temperature": 0.2,
-                    "response_mime_type": "application/json",
-                    "response_schema": self.response_schema
-                }
-            )
+            if not cache_hit:
+                prompt_parts = self._build_prompt_parts(inputs['metadata'], file_name, inputs['file_content'], use_rag)
+                
+                if cache_key:
+                    prompt_key = self._prompt_digest(prompt_parts, inputs.get('evidence_digest'))
+                    raw_response = self._get_cached_response(prompt_key)
+                    cache_hit = raw_response is not None
+                
+                if not cache_hit:
+                    if prompt_key:
+                        raw_response, compact_result, tokens_used, cache_hit = self._generate_coalesced(prompt_key, prompt_parts, incident_id)
+                    else:
+                        raw_response, compact_result, tokens_used = self._generate_validated(prompt_parts, incident_id)
             
-            response = model.generate_content(prompt_parts)
+            if compact_result is None and cache_hit:
+                compact_result = self._parse_response(raw_response)
+            if compact_result is None:
+                return {"success": False, "error": "Respuesta de Gemini fuera de esquema"}
             
             processing_time = time.time() - start_time
-            raw_response = response.text
-            compact_result = json.loads(raw_response)
             expanded = self._expand_response(compact_result)
             
-            tokens_used = 0
-            if hasattr(response, 'usage_metadata'):
-                tokens_used = getattr(response.usage_metadata, 'total_token_count', 0)
+            if prompt_key:
+                # La clave del incidente evita reconstruir el prompt la próxima vez; la del prompt ya se guardó al generar
+                self._store_cached_response(cache_key, raw_response)
             
             analysis_data = {
                 'incident_id': incident_id,
@@ -266,7 +568,8 @@ TIPO: {src.get('type', '?')} -> {dst.get('type', '?')}
                 'tokens_used': tokens_used
             }
             
-            analysis_id = self.db.insert_analysis(analysis_data)
+            # Con persist=False el llamador guarda el lote completo en una sola transacción
+            analysis_id = self.db.insert_analysis(analysis_data) if persist else None
             
             return {
                 "success": True,
@@ -281,10 +584,20 @@ TIPO: {src.get('type', '?')} -> {dst.get('type', '?')}
                 "indicators": expanded.get('indicators', []),
                 "processing_time": processing_time,
                 "tokens_used": tokens_used,
-                "has_file": file_content is not None,
-                "file_name": file_name
+                "has_file": file_name is not None,
+                "file_name": file_name,
+                "cache_hit": cache_hit,
+                "analysis_data": analysis_data
             }
         
         except Exception as e:
             logger.error(f"Error analizando {incident_id}: {e}")
-            return {"success": False, "error": str(e), "incident_id": incident_id}
\ No newline at end of file
+            return {"success": False, "error": str(e), "incident_id": incident_id}
+
+    async def analyze_incident_async(self, incident_id: str, incident_dir: Path, use_rag: bool = True, inputs: Optional[Dict] = None, persist: bool = True, executor: Optional[Executor] = None) -> Dict:
+        # El SDK de Gemini es bloqueante: se ejecuta en un hilo (del executor dado, o el por defecto del loop)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor,
+            functools.partial(self.analyze_incident, incident_id, incident_dir, use_rag, inputs, persist)
+        )
@@ -1,8 +1,13 @@
 import os
-import json
+import orjson
+import time
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set, Tuple
 import logging
 
 from db_manager import DatabaseManager
@@ -15,14 +20,32 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 BASE_INCIDENTS_DIR = os.getenv("INCIDENTS_DIR", "./data/incidents")
+ANALYSIS_CONCURRENCY = int(os.getenv("ANALYSIS_CONCURRENCY", "8"))
+PREFETCH_WORKERS = 4
+
+
+@contextmanager
+def _timed(timings: Dict[str, float], phase: str):
+    # Acumula segundos por fase; la descarga y el análisis se solapan, así que no suman el total
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = round(timings.get(phase, 0) + time.perf_counter() - start, 3)
 
 
 class IncidentProcessor:
     
-    def __init__(self):
+    def __init__(self, use_cache: bool = True):
         self.db = DatabaseManager()
-        self.analyzer = GeminiAnalyzer(db_manager=self.db)
+        self.analyzer = GeminiAnalyzer(db_manager=self.db, use_cache=use_cache)
         self.base_dir = Path(BASE_INCIDENTS_DIR)
         self.base_dir.mkdir(parents=True, exist_ok=True)
         logger.info("IncidentProcessor inicializado")
@@ -36,60 +59,123 @@ class IncidentProcessor:
         logger.info(f"Descarga completada: {len(new_incidents)} nuevos incidentes")
         return new_incidents
     
-    def run_analysis_cycle(self, max_incidents: int = 10) -> Dict:
+    def run_analysis_cycle(self, max_incidents: int = 10, incident_ids: Optional[List[str]] = None) -> Dict:
         logger.info(f"Iniciando ciclo de análisis (máx: {max_incidents})")
         
-        pending = self.db.get_pending_incidents(limit=max_incidents)
+        pending = self.db.get_pending_incidents(limit=max_incidents, incident_ids=incident_ids)
         
         if not pending:
             logger.info("No hay incidentes pendientes de análisis")
-            return {'analyzed': 0, 'errors': 0, 'total_tokens': 0}
+            return {'attempted': 0, 'analyzed': 0, 'errors': 0, 'total_tokens': 0, 'cache_hits': 0}
         
         results = {
+            'attempted': len(pending),
             'analyzed': 0,
             'errors': 0,
             'total_tokens': 0,
+            'cache_hits': 0,
             'details': []
         }
         
+        targets = []
+        present_by_date = {}
+        today = datetime.now().strftime('%Y-%m-%d')
         for incident in pending:
             incident_id = incident['incident_id']
-            incident_date = incident.get('incident_date', datetime.now().strftime('%Y-%m-%d'))
+            incident_date = incident.get('incident_date') or today
             incident_dir = self.base_dir / incident_date / incident_id
             
-            if not incident_dir.exists():
-                logger.warning(f"Directorio no existe: {incident_dir}")
+            # Un scandir por fecha en lugar de un stat por incidente
+            present = present_by_date.get(incident_date)
+            if present is None:
+                present = present_by_date[incident_date] = self._list_incident_dirs(incident_date)
+            
+            if incident_id not in present:
+                logger.warning("Directorio no existe: %s", incident_dir)
                 results['errors'] += 1
                 continue
             
+            targets.append((incident_id, incident_dir))
+        
+        analysis_results = asyncio.run(self._analyze_batch(targets)) if targets else []
+        
+        # Un solo commit para todos los análisis del ciclo
+        successful = [r for r in analysis_results if not isinstance(r, Exception) and r.get('success')]
+        persisted = self.db.insert_analyses_bulk([r['analysis_data'] for r in successful]) == len(successful)
+        
+        for (incident_id, incident_dir), analysis_result in zip(targets, analysis_results):
+            if isinstance(analysis_result, Exception):
+                results['errors'] += 1
+                logger.error("Excepción analizando %s: %s", incident_id, analysis_result)
+                continue
+            
             try:
-                analysis_result = self.analyzer.analyze_incident(
-                    incident_id=incident_id,
-                    incident_dir=incident_dir,
-                    use_rag=True
-                )
-                
-                if analysis_result['success']:
+                if analysis_result['success'] and not persisted:
+                    results['errors'] += 1
+                    logger.error("Análisis de %s no guardado en DB", incident_id)
+                elif analysis_result['success']:
                     self._save_analysis_to_file(incident_dir, analysis_result)
                     results['analyzed'] += 1
                     results['total_tokens'] += analysis_result.get('tokens_used', 0)
+                    results['cache_hits'] += analysis_result.get('cache_hit', False)
                     results['details'].append({
                         'incident_id': incident_id,
                         'verdict': analysis_result['verdict'],
                         'confidence': analysis_result['confidence']
                     })
-                    logger.info(f"Analizado: {incident_id} -> {analysis_result['verdict']}")
+                    logger.info("Analizado: %s -> %s", incident_id, analysis_result['verdict'])
                 else:
                     results['errors'] += 1
-                    logger.error(f"Error analizando {incident_id}: {analysis_result.get('error')}")
+                    logger.error("Error analizando %s: %s", incident_id, analysis_result.get('error'))
                     
             except Exception as e:
                 results['errors'] += 1
-                logger.error(f"Excepción analizando {incident_id}: {e}")
+                logger.error("Excepción analizando %s: %s", incident_id, e)
         
         logger.info(f"Ciclo completado: {results['analyzed']} analizados, {results['errors']} errores")
         return results
     
+    def _list_incident_dirs(self, incident_date: str) -> Set[str]:
+        try:
+            with os.scandir(self.base_dir / incident_date) as entries:
+                return {e.name for e in entries if e.is_dir()}
+        except FileNotFoundError:
+            return set()
+    
+    async def _analyze_batch(self, targets: List[Tuple[str, Path]]) -> List:
+        # Las llamadas a Gemini se lanzan en paralelo; el semáforo respeta el límite de peticiones por minuto
+        semaphore = asyncio.Semaphore(ANALYSIS_CONCURRENCY)
+        # La lectura de evidencia se adelanta mientras otros incidentes esperan a Gemini, con un tope de memoria
+        prefetch = asyncio.Semaphore(ANALYSIS_CONCURRENCY * 2)
+        
+        loop = asyncio.get_running_loop()
+        # Pools propios: el executor por defecto (cpu_count + 4 hilos) limitaría la concurrencia real
+        # y la lectura de evidencia encolada no debe retrasar las llamadas a Gemini
+        analysis_pool = ThreadPoolExecutor(max_workers=ANALYSIS_CONCURRENCY, thread_name_prefix="gemini")
+        prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+        
+        async def analyze(incident_id: str, incident_dir: Path) -> Dict:
+            async with prefetch:
+                inputs = await loop.run_in_executor(prefetch_pool, self.analyzer.load_incident_inputs, incident_dir)
+                async with semaphore:
+                    return await self.analyzer.analyze_incident_async(
+                        incident_id=incident_id,
+                        incident_dir=incident_dir,
+                        use_rag=True,
+                        inputs=inputs,
+                        persist=False,
+                        executor=analysis_pool
+                    )
+        
+        try:
+            return await asyncio.gather(
+                *(analyze(incident_id, incident_dir) for incident_id, incident_dir in targets),
+                return_exceptions=True
+            )
+        finally:
+            analysis_pool.shutdown(wait=False)
+            prefetch_pool.shutdown(wait=False)
+    
     def _save_analysis_to_file(self, incident_dir: Path, analysis_result: Dict):
         analysis_file = incident_dir / "analysis_result.json"
         
@@ -105,10 +191,9 @@ class IncidentProcessor:
             'processing_time': analysis_result.get('processing_time')
         }
         
-        with open(analysis_file, 'w', encoding='utf-8') as f:
-            json.dump(output, f, indent=2, ensure_ascii=False)
+        analysis_file.write_bytes(orjson.dumps(output, option=orjson.OPT_INDENT_2))
         
-        logger.debug(f"Análisis guardado: {analysis_file}")
+        logger.debug("Análisis guardado: %s", analysis_file)
     
     def run_full_cycle(self, hours_back: int = 24, max_analysis: int = 10) -> Dict:
         started_at = datetime.now()
@@ -118,9 +203,28 @@ class IncidentProcessor:
         logger.info("INICIANDO CICLO COMPLETO DE PROCESAMIENTO")
         logger.info("=" * 60)
         
-        new_incidents = self.run_download_cycle(hours_back=hours_back)
+        timings = {}
+        
+        def timed_download():
+            with _timed(timings, 'download'):
+                return self.run_download_cycle(hours_back)
         
-        analysis_results = self.run_analysis_cycle(max_incidents=max_analysis)
+        # La descarga corre en paralelo con el análisis de los pendientes de ciclos anteriores
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            download = pool.submit(timed_download)
+            with _timed(timings, 'analysis'):
+                analysis_results = self.run_analysis_cycle(max_incidents=max_analysis)
+            new_incidents = download.result()
+        
+        # El cupo que no usó el backlog se aprovecha solo para los recién descargados,
+        # sin reintentar en el mismo ciclo los pendientes que acaban de fallar
+        remaining = max_analysis - analysis_results['attempted']
+        if new_incidents and remaining > 0:
+            new_ids = [inc['incident_id'] for inc in new_incidents]
+            with _timed(timings, 'analysis'):
+                extra = self.run_analysis_cycle(max_incidents=remaining, incident_ids=new_ids)
+            for key in ('analyzed', 'errors', 'total_tokens', 'cache_hits'):
+                analysis_results[key] += extra[key]
         
         completed_at = datetime.now()
         
@@ -129,8 +233,11 @@ class IncidentProcessor:
             'incidents_downloaded': len(new_incidents),
             'incidents_analyzed': analysis_results['analyzed'],
             'total_tokens': analysis_results['total_tokens'],
+            'cache_hits': analysis_results['cache_hits'],
             'errors': analysis_results['errors'],
             'started_at': started_at.isoformat(),
+            'download_seconds': timings.get('download'),
+            'analysis_seconds': timings.get('analysis'),
             'completed_at': completed_at.isoformat()
         }
         
@@ -139,19 +246,19 @@ class IncidentProcessor:
         logger.info("=" * 60)
         logger.info(f"CICLO COMPLETADO en {(completed_at - started_at).seconds}s")
         logger.info(f"  Descargados: {len(new_incidents)}")
-        logger.info(f"  Analizados:  {analysis_results['analyzed']}")
+        logger.info(f"  Analizados:  {analysis_results['analyzed']} (caché: {analysis_results['cache_hits']})")
         logger.info(f"  Errores:     {analysis_results['errors']}")
+        logger.info(f"  Tiempos:     descarga {timings.get('download', 0):.1f}s, análisis {timings.get('analysis', 0):.1f}s")
         logger.info("=" * 60)
         
         return run_log
     
     def get_incident_summary(self, incident_id: str) -> Optional[Dict]:
-        incident = self.db.get_incident(incident_id)
-        if not incident:
+        found = self.db.get_incident_with_latest_analysis(incident_id)
+        if not found:
             return None
         
-        analysis = self.db.get_latest_analysis(incident_id)
-        
+        incident, analysis = found
         return {
             'incident': incident,
             'analysis': analysis
@@ -162,28 +269,28 @@ class IncidentProcessor:
             date = datetime.now().strftime('%Y-%m-%d')
         
         incidents = self.db.get_incidents_by_date(date)
+        analyses = self.db.get_latest_analyses_for([inc['incident_id'] for inc in incidents])
+        
+        # Una sola pasada por los incidentes del día
+        by_severity = Counter()
+        by_verdict = Counter()
+        pending = 0
+        for inc in incidents:
+            by_severity[inc.get('severity', 'unknown')] += 1
+            if inc.get('status') == 'downloaded':
+                pending += 1
+            analysis = analyses.get(inc['incident_id'])
+            if analysis:
+                by_verdict[analysis.get('gemini_verdict', 'unknown')] += 1
         
         summary = {
             'date': date,
             'total_incidents': len(incidents),
-            'by_verdict': {},
-            'by_severity': {},
-            'pending_analysis': 0
+            'by_verdict': dict(by_verdict),
+            'by_severity': dict(by_severity),
+            'pending_analysis': pending
         }
         
-        for inc in incidents:
-            sev = inc.get('severity', 'unknown')
-            summary['by_severity'][sev] = summary['by_severity'].get(sev, 0) + 1
-            
-            if inc.get('status') == 'downloaded':
-                summary['pending_analysis'] += 1
-        
-        for inc in incidents:
-            analysis = self.db.get_latest_analysis(inc['incident_id'])
-            if analysis:
-                verdict = analysis.get('gemini_verdict', 'unknown')
-                summary['by_verdict'][verdict] = summary['by_verdict'].get(verdict, 0) + 1
-        
         return summary
 
 
@@ -3,11 +3,6 @@ import sys
 import signal
 import logging
 from datetime import datetime
-from apscheduler.schedulers.blocking import BlockingScheduler
-from apscheduler.triggers.interval import IntervalTrigger
-from apscheduler.triggers.cron import CronTrigger
-
-from incident_processor import IncidentProcessor
 
 logging.basicConfig(
     level=logging.INFO,
@@ -27,9 +22,12 @@ CLEANUP_DAYS = int(os.getenv("CLEANUP_DAYS", "30"))
 
 class CyberTriageScheduler:
     
-    def __init__(self):
+    def __init__(self, use_cache: bool = True):
+        from apscheduler.schedulers.blocking import BlockingScheduler
+        
         self.scheduler = BlockingScheduler()
         self.processor = None
+        self.use_cache = use_cache
         self.is_running = False
         self._setup_signal_handlers()
     
@@ -43,7 +41,9 @@ class CyberTriageScheduler:
     
     def _init_processor(self):
         if self.processor is None:
-            self.processor = IncidentProcessor()
+            # Import diferido: google.generativeai y boto3 solo se cargan al procesar
+            from incident_processor import IncidentProcessor
+            self.processor = IncidentProcessor(use_cache=self.use_cache)
         return self.processor
     
     def job_process_incidents(self):
@@ -82,6 +82,9 @@ class CyberTriageScheduler:
             logger.error(f"HEALTH: FAIL | {e}")
     
     def start(self):
+        from apscheduler.triggers.interval import IntervalTrigger
+        from apscheduler.triggers.cron import CronTrigger
+        
         logger.info("=" * 60)
         logger.info("CYBER-TRIAGE SCHEDULER INICIANDO")
         logger.info(f"  Intervalo de escaneo: {SCAN_INTERVAL_MINUTES} minutos")
@@ -135,9 +138,11 @@ class CyberTriageScheduler:
             logger.info("Scheduler detenido correctamente")
 
 
-def run_once():
+def run_once(use_cache: bool = True):
+    from incident_processor import IncidentProcessor
+    
     logger.info("Ejecutando ciclo único (sin scheduler)")
-    processor = IncidentProcessor()
+    processor = IncidentProcessor(use_cache=use_cache)
     result = processor.run_full_cycle(
         hours_back=HOURS_BACK,
         max_analysis=MAX_ANALYSIS_PER_CYCLE
@@ -151,14 +156,15 @@ def main():
     parser = argparse.ArgumentParser(description='Cyber-Triage Scheduler')
     parser.add_argument('--once', action='store_true', help='Ejecutar un solo ciclo y salir')
     parser.add_argument('--daemon', action='store_true', help='Ejecutar como daemon continuo')
+    parser.add_argument('--no-cache', action='store_true', help='Ignorar la caché de respuestas de Gemini')
     args = parser.parse_args()
     
     if args.once:
-        result = run_once()
+        result = run_once(use_cache=not args.no_cache)
         print(f"Resultado: {result}")
         sys.exit(0)
     else:
-        scheduler = CyberTriageScheduler()
+        scheduler = CyberTriageScheduler(use_cache=not args.no_cache)
         scheduler.start()
 
 